@@ -1,18 +1,26 @@
+import concurrent.futures
+import contextlib
 import csv
 import datetime
 import decimal
+import functools
+import io
 import os
 import re
 import sqlite3
 import sys
 import time
+from collections.abc import Callable
 from dataclasses import dataclass
 from pathlib import Path
 
+import lxml.etree
 import lxml.html
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
 
 DB_PATH_ENV = "TW_STOCK_DB_PATH"
 QUOTE_EPOCH = datetime.date(2007, 4, 23)  # TWSE/OTC overlap coverage
@@ -20,14 +28,33 @@ TWSE_HISTORY_EPOCH = datetime.date(1999, 1, 1)
 
 _TWSE_ID_RE = re.compile(r"^\d{4}[A-Z]?$")
 _OTC_ID_RE = re.compile(r"^\d{4}$")
+_CLEAN_DQ_RE = re.compile(r'="([^"]*)"')
+_CLEAN_SQ_RE = re.compile(r"='([^']*)'")
+_TR_XPATH = lxml.etree.XPath("//tr")
+_CHINESE_DATE_RE = re.compile(r"^(\d+)([./-])(\d+)\2(\d+)$")
+_NUM_RE = re.compile(r"^[+-]?[0-9]+(?:\.[0-9]+)?$")
+_CLEAN_TABLE = str.maketrans("", "", " ,\t\u2295\u2299")
 _DB_CONN: sqlite3.Connection | None = None
+_SESSION: requests.Session | None = None
+_UNVERIFIED_HOSTS: set[str] = set()
+_FETCH_ARRAYSIZE = 256
+_DB_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -20000",
+    "PRAGMA temp_store = MEMORY",
+)
+_STOCK_UPSERT_SQL = (
+    "INSERT INTO stock (ID, name, market, mindate, maxdate) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(ID) DO UPDATE SET name = excluded.name, market = excluded.market, maxdate = excluded.maxdate"
+)
 
 # Avoid sqlite3 default adapter deprecation warnings on Python 3.12+.
 sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
 sqlite3.register_adapter(datetime.datetime, lambda dt: dt.isoformat(sep=" "))
 
 
-@dataclass
+@dataclass(frozen=True)
 class StockInfo:
     id: str
     name: str
@@ -61,7 +88,16 @@ def _require_db_path() -> Path:
 def get_db() -> sqlite3.Connection:
     global _DB_CONN
     if _DB_CONN is None:
-        _DB_CONN = sqlite3.connect(_require_db_path())
+        # Autocommit mode: writers demarcate their own transactions via _write_transaction().
+        db = sqlite3.connect(_require_db_path(), isolation_level=None, cached_statements=512)
+        try:
+            # These pragmas are per-connection and write nothing, so read-only databases accept them too.
+            for pragma in _DB_PRAGMAS:
+                db.execute(pragma)
+        except BaseException:
+            db.close()
+            raise
+        _DB_CONN = db
     return _DB_CONN
 
 
@@ -70,6 +106,34 @@ def close_db() -> None:
     if _DB_CONN is not None:
         _DB_CONN.close()
         _DB_CONN = None
+    stock_info.cache_clear()
+
+
+@contextlib.contextmanager
+def _write_transaction():
+    db = get_db()
+    # Persistent and a no-op once set; kept on the write path so read-only databases still open.
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("CREATE INDEX IF NOT EXISTS idx_stock_market_dates ON stock (market, mindate, maxdate)")
+        yield db
+        db.execute("COMMIT")
+    except BaseException:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    stock_info.cache_clear()
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_date_str(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_date(value: datetime.date) -> str:
+    return value.strftime("%Y-%m-%d")
 
 
 def to_date(value):
@@ -80,7 +144,7 @@ def to_date(value):
     if isinstance(value, datetime.date):
         return value
     if isinstance(value, str):
-        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+        return _parse_date_str(value)
     raise TypeError(f"Unsupported date value: {value!r}")
 
 
@@ -88,7 +152,7 @@ def date_str(value) -> str | None:
     d = to_date(value)
     if d is None:
         return None
-    return d.strftime("%Y-%m-%d")
+    return _format_date(d)
 
 
 def is_twse(stock_id: str | None):
@@ -100,52 +164,89 @@ def is_otc(stock_id: str | None):
 
 
 def is_id(stock_id: str) -> bool:
-    if len(stock_id) <= 0:
+    if not stock_id[:1].isdecimal():
         return False
-    if not re.match(r"^\d+[A-Z]?", stock_id):
-        return False
-    if len(stock_id) > 4 and stock_id.startswith("7"):
-        return False
-    if not stock_id.startswith("0"):
-        return True
-    return stock_id.startswith("00") or stock_id.startswith("01") or stock_id.startswith("02")
+    if stock_id[0] == "7":
+        return len(stock_id) <= 4
+    if stock_id[0] == "0":
+        return stock_id[1:2] in ("0", "1", "2")
+    return True
 
 
 def clean(text: str) -> str:
-    m = re.match(r'="([^"]*)"', text)
+    m = _CLEAN_DQ_RE.match(text)
     if m:
         text = m.group(1)
-    m = re.match(r"='([^']*)'", text)
+    m = _CLEAN_SQ_RE.match(text)
     if m:
         text = m.group(1)
-    return (
-        text.replace(" ", "")
-        .replace(",", "")
-        .replace("\t", "")
-        .replace("&nbsp;", "")
-        .replace("\u2295", "")
-        .replace("\u2299", "")
-        .strip()
-    )
+    return text.translate(_CLEAN_TABLE).replace("&nbsp;", "").strip()
 
 
 def to_decimal(value: str) -> str:
     return str(decimal.Decimal(value))
 
 
+def _get_session() -> requests.Session:
+    global _SESSION
+    if _SESSION is None:
+        # Keep-alive across the many same-host requests of a backfill. Retry once on connection and read
+        # errors (a dropped keep-alive socket is a read error); callers already retry whole downloads,
+        # and SSL errors must reach _http_get() at once.
+        retry = Retry(total=1, connect=1, read=1, status=0, other=0, backoff_factor=1)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+        _SESSION = requests.Session()
+        _SESSION.mount("https://", adapter)
+        _SESSION.mount("http://", adapter)
+    return _SESSION
+
+
 def _http_get(url: str, timeout: int = 30) -> requests.Response:
+    session = _get_session()
+    host = urllib3.util.parse_url(url).host
+    if host in _UNVERIFIED_HOSTS:
+        response = session.get(url, timeout=timeout, verify=False)
+        response.raise_for_status()
+        return response
     try:
-        response = requests.get(url, timeout=timeout)
+        response = session.get(url, timeout=timeout)
         response.raise_for_status()
         return response
     except requests.exceptions.SSLError:
         # Some TWSE cert chains may fail strict verification on specific Windows/Python builds.
         urllib3.disable_warnings(InsecureRequestWarning)
-        response = requests.get(url, timeout=timeout, verify=False)
+        _UNVERIFIED_HOSTS.add(host)
+        response = session.get(url, timeout=timeout, verify=False)
         response.raise_for_status()
         return response
 
 
+def _read_csv(response: requests.Response, line_filter=None):
+    text = io.TextIOWrapper(io.BytesIO(response.content), encoding="cp950", errors="ignore", newline="")
+    if line_filter is not None:
+        text = _filter_records(text, line_filter)
+    return csv.reader(text)
+
+
+def _filter_records(lines, line_filter):
+    # Decide on the first line of each CSV record and apply it to the lines a quoted cell spans,
+    # so a multi-line cell is never cut in half.
+    in_quote = False
+    keep = True
+    for line in lines:
+        if not in_quote:
+            keep = line_filter(line)
+        if line.count('"') % 2:
+            in_quote = not in_quote
+        if keep:
+            yield line
+
+
+def _may_start_with_id(line: str) -> bool:
+    # Cheap pre-check before csv parsing: is_id() needs the cleaned first cell to start with a digit.
+    return line.lstrip("=\"' \t\u2295\u2299")[:1].isdecimal()
+
+
 def db_max_date():
     max_date, = get_db().execute(
         "SELECT MAX(maxdate) FROM stock WHERE ID != 'TWSE' AND ID != 'OTC'"
@@ -191,10 +292,17 @@ def list_stocks(begin_date=None, end_date=None, market=None):
         "SELECT ID, name, future, mini_future, mindate, maxdate "
         f"FROM stock_future_view WHERE {where_sql} ORDER BY ID"
     )
-    for row in get_db().execute(sql, params):
-        yield StockInfo(*row)
+    cur = get_db().execute(sql, params)
+    cur.arraysize = _FETCH_ARRAYSIZE
+    while True:
+        rows = cur.fetchmany()
+        if not rows:
+            break
+        for row in rows:
+            yield StockInfo(*row)
 
 
+@functools.lru_cache(maxsize=4096)
 def stock_info(stock_id: str) -> StockInfo | None:
     row = get_db().execute(
         "SELECT ID, name, future, mini_future, mindate, maxdate "
@@ -234,22 +342,31 @@ def fetch_quotes(
         sql += " LIMIT ?"
         params.append(limit)
 
-    return list(get_db().execute(sql, tuple(params)))
+    cur = get_db().execute(sql, tuple(params))
+    cur.arraysize = _FETCH_ARRAYSIZE
+    return cur.fetchall()
 
 
 def _upsert_market_marker(market: str, date: datetime.date, count: int) -> None:
     db = get_db()
     db.execute(
-        "INSERT OR IGNORE INTO stock (ID, name, market, mindate, maxdate) VALUES (?, ?, ?, ?, ?)",
+        "INSERT INTO stock (ID, name, market, mindate, maxdate) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(ID) DO UPDATE SET maxdate = excluded.maxdate",
         (market, market, market, date, date),
     )
-    db.execute("UPDATE stock SET maxdate = ? WHERE ID = ?", (date, market))
     db.execute(
         "INSERT OR REPLACE INTO quote (ID, date, volume) VALUES (?, ?, ?)",
         (market, date, count),
     )
 
 
+def _delete_daily_quotes(market: str, date: datetime.date) -> None:
+    get_db().execute(
+        "DELETE FROM quote WHERE (ID IN (SELECT ID FROM stock WHERE market = ?) OR ID = ?) AND date = ?",
+        (market, market, date),
+    )
+
+
 def _safe_int(value: str) -> int | None:
     value = clean(value)
     if value == "":
@@ -264,101 +381,151 @@ def _safe_decimal(value: str) -> str | None:
     value = clean(value)
     if value in {"", "---", "--"}:
         return None
+    if _NUM_RE.match(value):
+        return value.lstrip("+")
+    # Rare cells such as full-width digits still go through Decimal to be normalized to ASCII.
     try:
         return to_decimal(value)
     except decimal.InvalidOperation:
         return None
 
 
-def update_daily_twse_quotes(date, force: bool = False) -> None:
+def _is_positive_decimal_str(value: str) -> bool:
+    # Expects a _safe_decimal() result: unsigned or "-"-prefixed, so any nonzero mantissa digit means > 0.
+    return not value.startswith("-") and value.partition("E")[0].strip("0.") != ""
+
+
+def _download_daily_twse_quotes(date: datetime.date) -> requests.Response:
+    url = f"https://www.twse.com.tw/exchangeReport/MI_INDEX?response=csv&date={date:%Y%m%d}&type=ALL"
+    print(f"retrieving {url}")
+    response = _http_get(url)
+    time.sleep(5)  # TWSE may reject bursty requests
+    return response
+
+
+def _download_daily_otc_quotes(date: datetime.date) -> requests.Response:
+    url = f"http://www.tpex.org.tw/www/zh-tw/afterTrading/dailyQuotes?date={date:%Y/%m/%d}&response=csv"
+    print(f"retrieving {url}")
+    response = _http_get(url)
+    time.sleep(0.1)
+    return response
+
+
+def _parse_twse_row(row: list[str], date: datetime.date) -> tuple[str, str, tuple] | None:
+    if len(row) < 11:
+        return None
+    stock_id = clean(row[0])
+    if not is_id(stock_id):
+        return None
+    volume = _safe_int(row[2])
+    opening = _safe_decimal(row[5])
+    if volume is None or volume <= 0 or opening is None:
+        return None
+
+    turnover = _safe_int(row[4])
+    high = _safe_decimal(row[6])
+    low = _safe_decimal(row[7])
+    closing = _safe_decimal(row[8])
+    tickcount = _safe_int(row[3])
+    if (
+        turnover is None
+        or high is None
+        or low is None
+        or closing is None
+        or tickcount is None
+    ):
+        return None
+
+    if not (
+        _is_positive_decimal_str(opening)
+        and _is_positive_decimal_str(high)
+        and _is_positive_decimal_str(low)
+        and _is_positive_decimal_str(closing)
+    ):
+        return None
+
+    delta = None if clean(row[9]) == "X" else _safe_decimal(row[10])
+    quote = (stock_id, date, volume, turnover, opening, high, low, closing, delta, tickcount)
+    return stock_id, clean(row[1]), quote
+
+
+def _parse_otc_row(row: list[str], date: datetime.date) -> tuple[str, str, tuple] | None:
+    if len(row) < 11:
+        return None
+    stock_id = clean(row[0])
+    if not is_id(stock_id):
+        return None
+    volume = _safe_int(row[8])
+    opening = _safe_decimal(row[4])
+    if volume is None or volume <= 0 or opening is None:
+        return None
+
+    closing = _safe_decimal(row[2])
+    high = _safe_decimal(row[5])
+    low = _safe_decimal(row[6])
+    turnover = _safe_int(row[9])
+    tickcount = _safe_int(row[10])
+    if (
+        closing is None
+        or high is None
+        or low is None
+        or turnover is None
+        or tickcount is None
+    ):
+        return None
+
+    if not (
+        _is_positive_decimal_str(opening)
+        and _is_positive_decimal_str(high)
+        and _is_positive_decimal_str(low)
+        and _is_positive_decimal_str(closing)
+    ):
+        return None
+
+    delta = _safe_decimal(row[3])
+    quote = (date, stock_id, closing, delta, opening, high, low, volume, turnover, tickcount)
+    return stock_id, clean(row[1]), quote
+
+
+def update_daily_twse_quotes(
+    date,
+    force: bool = False,
+    download: Callable[[datetime.date], requests.Response] | None = None,
+) -> None:
     date = to_date(date)
     db = get_db()
     market = "TWSE"
+    if download is None:
+        download = _download_daily_twse_quotes
 
     if db.execute("SELECT 1 FROM quote WHERE ID = ? AND date = ?", (market, date)).fetchone() and not force:
         return
 
-    if force:
-        db.execute(
-            "DELETE FROM quote WHERE (ID IN (SELECT ID FROM stock WHERE market = ?) OR ID = ?) AND date = ?",
-            (market, market, date),
-        )
-
-    yyyymmdd = date.strftime("%Y%m%d")
-    url = f"https://www.twse.com.tw/exchangeReport/MI_INDEX?response=csv&date={yyyymmdd}&type=ALL"
-
     for retry in range(3):
         try:
-            print(f"retrieving {url}")
-            count = 0
-            response = _http_get(url)
-            time.sleep(5)  # TWSE may reject bursty requests
-            for row in csv.reader(response.content.decode("cp950", errors="ignore").split("\r\n")):
-                    if len(row) < 11:
-                        continue
-                    stock_id = clean(row[0])
-                    if not is_id(stock_id):
-                        continue
-                    name = clean(row[1])
-                    volume = _safe_int(row[2])
-                    opening = _safe_decimal(row[5])
-                    if volume is None or volume <= 0 or opening is None:
-                        continue
-
-                    turnover = _safe_int(row[4])
-                    high = _safe_decimal(row[6])
-                    low = _safe_decimal(row[7])
-                    closing = _safe_decimal(row[8])
-                    tickcount = _safe_int(row[3])
-                    delta = None if clean(row[9]) == "X" else _safe_decimal(row[10])
-
-                    if (
-                        turnover is None
-                        or high is None
-                        or low is None
-                        or closing is None
-                        or tickcount is None
-                    ):
-                        continue
-
-                    if (
-                        float(opening) <= 0
-                        or float(high) <= 0
-                        or float(low) <= 0
-                        or float(closing) <= 0
-                    ):
-                        continue
-
-                    db.execute(
-                        "INSERT INTO quote (ID, date, volume, turnover, open, high, low, close, delta, tickcount) "
-                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            stock_id,
-                            date,
-                            volume,
-                            turnover,
-                            opening,
-                            high,
-                            low,
-                            closing,
-                            delta,
-                            tickcount,
-                        ),
-                    )
-                    inserted = db.execute(
-                        "INSERT OR IGNORE INTO stock (ID, name, market, mindate, maxdate) VALUES (?, ?, ?, ?, ?)",
-                        (stock_id, name, market, date, date),
-                    )
-                    if inserted.rowcount <= 0:
-                        db.execute(
-                            "UPDATE stock SET name = ?, market = ?, maxdate = ? WHERE ID = ?",
-                            (name, market, date, stock_id),
-                        )
-                    count += 1
-
+            response = download(date)
+            quote_rows = []
+            stock_upserts = []
+            for row in _read_csv(response, _may_start_with_id):
+                parsed = _parse_twse_row(row, date)
+                if parsed is None:
+                    continue
+                stock_id, name, quote = parsed
+                quote_rows.append(quote)
+                stock_upserts.append((stock_id, name, market, date, date))
+
+            count = len(quote_rows)
+            with _write_transaction():
+                if force:
+                    _delete_daily_quotes(market, date)
+                db.executemany(
+                    "INSERT INTO quote (ID, date, volume, turnover, open, high, low, close, delta, tickcount) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    quote_rows,
+                )
+                db.executemany(_STOCK_UPSERT_SQL, stock_upserts)
+                _upsert_market_marker(market, date, count)
             print(f"{date}: {count} records inserted")
-            _upsert_market_marker(market, date, count)
-            db.commit()
             break
         except Exception as exc:
             print(repr(exc))
@@ -366,95 +533,45 @@ def update_daily_twse_quotes(date, force: bool = False) -> None:
                 raise
 
 
-def update_daily_otc_quotes(date, force: bool = False) -> None:
+def update_daily_otc_quotes(
+    date,
+    force: bool = False,
+    download: Callable[[datetime.date], requests.Response] | None = None,
+) -> None:
     date = to_date(date)
     db = get_db()
     market = "OTC"
+    if download is None:
+        download = _download_daily_otc_quotes
 
     if db.execute("SELECT 1 FROM quote WHERE ID = ? AND date = ?", (market, date)).fetchone() and not force:
         return
 
-    if force:
-        db.execute(
-            "DELETE FROM quote WHERE (ID IN (SELECT ID FROM stock WHERE market = ?) OR ID = ?) AND date = ?",
-            (market, market, date),
-        )
-
-    url = f"http://www.tpex.org.tw/www/zh-tw/afterTrading/dailyQuotes?date={date:%Y/%m/%d}&response=csv"
-
     for retry in range(3):
         try:
-            print(f"retrieving {url}")
-            count = 0
-            response = _http_get(url)
-            time.sleep(0.1)
-            for row in csv.reader(response.content.decode("cp950", errors="ignore").split("\r\n")):
-                if len(row) < 11:
-                    continue
-                stock_id = clean(row[0])
-                if not is_id(stock_id):
-                    continue
-
-                name = clean(row[1])
-                closing = _safe_decimal(row[2])
-                delta = _safe_decimal(row[3])
-                volume = _safe_int(row[8])
-                opening = _safe_decimal(row[4])
-                high = _safe_decimal(row[5])
-                low = _safe_decimal(row[6])
-                turnover = _safe_int(row[9])
-                tickcount = _safe_int(row[10])
-
-                if (
-                    closing is None
-                    or volume is None
-                    or volume <= 0
-                    or opening is None
-                    or high is None
-                    or low is None
-                    or turnover is None
-                    or tickcount is None
-                ):
-                    continue
-
-                if (
-                    float(opening) <= 0
-                    or float(high) <= 0
-                    or float(low) <= 0
-                    or float(closing) <= 0
-                ):
+            response = download(date)
+            quote_rows = []
+            stock_upserts = []
+            for row in _read_csv(response, _may_start_with_id):
+                parsed = _parse_otc_row(row, date)
+                if parsed is None:
                     continue
-
-                db.execute(
+                stock_id, name, quote = parsed
+                quote_rows.append(quote)
+                stock_upserts.append((stock_id, name, market, date, date))
+
+            count = len(quote_rows)
+            with _write_transaction():
+                if force:
+                    _delete_daily_quotes(market, date)
+                db.executemany(
                     "INSERT INTO quote (date, ID, close, delta, open, high, low, volume, turnover, tickcount) "
                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        date,
-                        stock_id,
-                        closing,
-                        delta,
-                        opening,
-                        high,
-                        low,
-                        volume,
-                        turnover,
-                        tickcount,
-                    ),
-                )
-                inserted = db.execute(
-                    "INSERT OR IGNORE INTO stock (ID, name, market, mindate, maxdate) VALUES (?, ?, ?, ?, ?)",
-                    (stock_id, name, market, date, date),
+                    quote_rows,
                 )
-                if inserted.rowcount <= 0:
-                    db.execute(
-                        "UPDATE stock SET name = ?, market = ?, maxdate = ? WHERE ID = ?",
-                        (name, market, date, stock_id),
-                    )
-                count += 1
-
+                db.executemany(_STOCK_UPSERT_SQL, stock_upserts)
+                _upsert_market_marker(market, date, count)
             print(f"{date}: {count} records inserted")
-            _upsert_market_marker(market, date, count)
-            db.commit()
             break
         except Exception as exc:
             print(repr(exc))
@@ -462,6 +579,23 @@ def update_daily_otc_quotes(date, force: bool = False) -> None:
                 raise
 
 
+def _prefetched_download(
+    executor: concurrent.futures.Executor,
+    download: Callable[[datetime.date], requests.Response],
+    prefetched: concurrent.futures.Future,
+) -> Callable[[datetime.date], requests.Response]:
+    # The first attempt takes the prefetched response; retries queue on the same single-worker
+    # executor, behind any download already in flight, so requests never overlap.
+    def fetch(date: datetime.date) -> requests.Response:
+        nonlocal prefetched
+        if prefetched is not None:
+            future, prefetched = prefetched, None
+            return future.result()
+        return executor.submit(download, date).result()
+
+    return fetch
+
+
 def continue_update_quotes() -> None:
     now = datetime.datetime.now()
     today = now.date()
@@ -475,23 +609,35 @@ def continue_update_quotes() -> None:
     twse_from = QUOTE_EPOCH if twse_last is None else to_date(twse_last) + datetime.timedelta(days=1)
     otc_from = QUOTE_EPOCH if otc_last is None else to_date(otc_last) + datetime.timedelta(days=1)
 
+    jobs = []
     current = min(twse_from, otc_from)
     while current <= today:
         if current >= twse_from:
-            update_daily_twse_quotes(current)
+            jobs.append((_download_daily_twse_quotes, update_daily_twse_quotes, current))
         if current >= otc_from:
-            update_daily_otc_quotes(current)
+            jobs.append((_download_daily_otc_quotes, update_daily_otc_quotes, current))
         current += datetime.timedelta(days=1)
 
+    # Download the next day on a single worker, so requests stay serialized and rate-limited,
+    # while this thread parses and writes the current one.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for i, (download, update, date) in enumerate(jobs):
+            if pending is None:
+                pending = executor.submit(download, date)
+            prefetched = pending
+            if i + 1 < len(jobs):
+                next_download, _, next_date = jobs[i + 1]
+                pending = executor.submit(next_download, next_date)
+            else:
+                pending = None
+            update(date, download=_prefetched_download(executor, download, prefetched))
+
 
 def chinese_date(expression: str) -> datetime.date:
-    m = (
-        re.match(r"^(\d+)\.(\d+)\.(\d+)$", expression)
-        or re.match(r"^(\d+)/(\d+)/(\d+)$", expression)
-        or re.match(r"^(\d+)-(\d+)-(\d+)$", expression)
-    )
+    m = _CHINESE_DATE_RE.match(expression)
     if m:
-        return datetime.date(int(m.group(1)) + 1911, int(m.group(2)), int(m.group(3)))
+        return datetime.date(int(m.group(1)) + 1911, int(m.group(3)), int(m.group(4)))
     raise ValueError(f"{expression!r} is not a Chinese date")
 
 
@@ -501,10 +647,10 @@ def update_monthly_twse_history(year: int, month: int) -> None:
     print(f"retrieving {url}")
 
     count = 0
-    db = get_db()
     response = _http_get(url)
     time.sleep(5)
-    for row in csv.reader(response.content.decode("cp950", errors="ignore").split("\r\n")):
+    with _write_transaction() as db:
+        for row in _read_csv(response):
             if len(row) < 5:
                 continue
             try:
@@ -523,7 +669,6 @@ def update_monthly_twse_history(year: int, month: int) -> None:
             count += 1
 
     print(f"year={year} month={month}: {count} records inserted")
-    db.commit()
 
 
 def update_twse_history() -> None:
@@ -542,11 +687,10 @@ def update_twse_history() -> None:
 
 def stock_future_codes() -> None:
     doc = lxml.html.fromstring(_http_get("https://www.taifex.com.tw/cht/2/stockLists").text)
-    db = get_db()
-    db.execute("DELETE FROM stock_future")
 
-    count = 0
-    for tr in doc.xpath("//tr"):
+    futures = []
+    mini_futures = []
+    for tr in _TR_XPATH(doc):
         row = [td.text_content().strip() for td in tr.iter("td")]
         if len(row) < 11:
             continue
@@ -557,20 +701,25 @@ def stock_future_codes() -> None:
         if not is_id(stock_id):
             continue
 
-        exists = db.execute("SELECT 1 FROM stock_future WHERE ID = ?", (stock_id,)).fetchone()
         if multiplier == "100":
-            if exists:
-                db.execute("UPDATE stock_future SET mini_future = ? WHERE ID = ?", (code, stock_id))
-            else:
-                db.execute("INSERT OR REPLACE INTO stock_future (ID, mini_future) VALUES (?, ?)", (stock_id, code))
+            mini_futures.append((stock_id, code))
         else:
-            if exists:
-                db.execute("UPDATE stock_future SET future = ? WHERE ID = ?", (code, stock_id))
-            else:
-                db.execute("INSERT OR REPLACE INTO stock_future (ID, future) VALUES (?, ?)", (stock_id, code))
-        count += 1
+            futures.append((stock_id, code))
+    count = len(futures) + len(mini_futures)
+
+    with _write_transaction() as db:
+        db.execute("DELETE FROM stock_future")
+        db.executemany(
+            "INSERT INTO stock_future (ID, future) VALUES (?, ?) "
+            "ON CONFLICT(ID) DO UPDATE SET future = excluded.future",
+            futures,
+        )
+        db.executemany(
+            "INSERT INTO stock_future (ID, mini_future) VALUES (?, ?) "
+            "ON CONFLICT(ID) DO UPDATE SET mini_future = excluded.mini_future",
+            mini_futures,
+        )
 
-    db.commit()
     print(f"stock_future_codes() {count} rows processed")
 
 